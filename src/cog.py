@@ -3,10 +3,11 @@
 # The intents required by this bot are:
 #     voice_states
 
+import asyncio
+from collections import OrderedDict
 import discord
 from discord import Option
 from discord import ApplicationContext
-from discord import WebhookMessage
 from discord import Interaction
 from discord import Embed
 from discord.ext import commands
@@ -16,6 +17,15 @@ from song import Song
 from song_cache import SongCache
 from log import globalLog as gLog
 
+# The maximum amount of guild queues tracked at once. When a new queue would
+# exceed this, the least recently used one is destroyed.
+MAX_QUEUES = 1024
+
+# Values returned by `Siren.get_server_queue` instead of a queue
+_NO_AUTHOR_VC  = object()  # The author is not in a VC
+_BOT_NOT_IN_VC = object()  # The bot is not in a VC
+_MISMATCH_VC   = object()  # The author is not in the same VC as the bot
+
 def get_affinity() -> int:
     """Returns the affinity of the current process if possible.
     If not possible, returns the number of CPUs on the system."""
@@ -39,14 +49,14 @@ class Siren(commands.Cog):
         # The bot this cog is assigned to
         self.bot = bot
 
-        # Queues of the servers this bot is in
+        # Queues of the servers this bot is in, least recently used first
         # { guild_id: SongQueue }
-        self.queues = {}
+        self.queues = OrderedDict()
 
         # Inner song metadata cache
         if caching_processes < 1:
             caching_processes = get_affinity()
-        self.song_cache = SongCache(pool_size=caching_processes)
+        self.song_cache = SongCache.get(pool_size=caching_processes)
 
         gLog.debug("Siren cog initialized.")
 
@@ -58,13 +68,20 @@ class Siren(commands.Cog):
         If the author is not in a voice channel, or the bot can't join it,
         send an error message.
         """
-        gLog.debug(f"Got `/join`: {ctx.guild.name} >> {ctx.author}")
+        gLog.debug("Got `/join`: %s >> %s", ctx.guild.name, ctx.author)
 
         # Check if we aren't connected to a voice channel already
         # and make sure that the author is in a VC
-        (queue, response) = await self.get_server_queue(ctx)
-        if queue is not None:
+        queue = await self.get_server_queue(ctx)
+        if type(queue) is SongQueue:
+            await ctx.respond(content="I'm already in your VC.", ephemeral=True)
             return
+        if queue is not _BOT_NOT_IN_VC:
+            return
+
+        # `get_server_queue` has already told the author that we aren't
+        # connected. That's the message we edit with the result.
+        response = ctx.interaction
 
         # Create a new queue
         queue = SongQueue(song_cache=self.song_cache)
@@ -79,6 +96,16 @@ class Siren(commands.Cog):
             await response.edit_original_message(
                     content="Couldn't join the voice channel.")
             gLog.error(f"Joining a voice channel in: {ctx.guild.name} -- {e}")
+            return
+
+        # Evict the least recently used queues if we track too many
+        while len(self.queues) > MAX_QUEUES:
+            (guild_id, evicted) = self.queues.popitem(last=False)
+            gLog.info(f"Evicting the queue of guild: {guild_id}")
+            try:
+                await evicted.destroy()
+            except Exception as e:
+                gLog.error(f"Evicting the queue of guild: {guild_id} -- {e}")
 
 
     @commands.slash_command(name="leave", description="Leave the voice channel")
@@ -88,218 +115,239 @@ class Siren(commands.Cog):
         If the author of the message is not in the same channel,
         the bot won't leave.
         """
-        gLog.debug(f"Got `/leave`: {ctx.guild.name} >> {ctx.author}")
+        gLog.debug("Got `/leave`: %s >> %s", ctx.guild.name, ctx.author)
 
         # Get the queue for this guild and make sure we are connected to the
         # same VC as the author
-        (queue, response) = await self.get_server_queue(ctx)
-        if not isinstance(queue, SongQueue):
+        queue = await self.get_server_queue(ctx)
+        if type(queue) is not SongQueue:
             return
 
         # Try and leave the voice channel
         try:
             await queue.destroy()
-            self.queues.pop(ctx.guild_id)
-            await response.edit_original_message(content="Disconnected!")
-            gLog.info(f"Left a voice channel in: {ctx.guild.name}")
         except Exception as e:
-            await response.edit_original_message(
-                    content="Couldn't leave the voice channel.")
             gLog.error(f"Leaving a voice channel in: {ctx.guild.name} -- {e}")
+            await ctx.respond(content="Couldn't leave the voice channel.")
+            return
+
+        # The queue is gone now, whatever happens to the response
+        self.queues.pop(ctx.guild_id, None)
+        gLog.info(f"Left a voice channel in: {ctx.guild.name}")
+        await ctx.respond(content="Disconnected!")
 
 
     @commands.slash_command(name="play", description="Play something in a VC",
         query=Option(str, "The query to play", min_length=1, required=True))
     async def play(self, ctx: ApplicationContext, query):
         """Puts a song (or a playlist) into the queue."""
-        gLog.debug(f"Got `/play`: {ctx.guild.name} >> {ctx.author}")
+        gLog.debug("Got `/play`: %s >> %s", ctx.guild.name, ctx.author)
 
         # Get the queue for this guild and make sure we are connected to the
         # same VC as the author
-        (queue, response) = await self.get_server_queue(ctx)
-        if not isinstance(queue, SongQueue):
+        queue = await self.get_server_queue(ctx)
+        if type(queue) is not SongQueue:
             return
 
         # If the query is empty, bail out
         if not query:
-            await response.edit_original_message(content="The query is empty.")
+            await ctx.respond(content="The query is empty.")
             return
 
-        # Edit the message to reflect our query status
-        await response.edit_original_message(content="Querying...")
+        # Respond right away, the query may take a while
+        response = await ctx.respond(content="Querying...")
 
         gLog.info(f"Got a song query: {query}")
 
         # Get a list of urls to a playlist (if a playlist was given, otherwise
-        # just get [single_url]) and append them to the queue
-        urls = get_urls_from_query(query)
-        queue += urls
+        # just get [single_url]) and append them to the queue.
+        # The extraction is blocking network I/O, so run it in the default
+        # executor to keep the event loop responsive to other commands.
+        loop = asyncio.get_running_loop()
+        urls = await loop.run_in_executor(None, get_urls_from_query, query)
+        queue.extend(urls)
 
         # Edit the message to reflect our query status.
         query_msg = f"Queued up {len(urls)} song"
         if len(urls) != 1:
             query_msg += "s"
 
-        gLog.debug(f"{query_msg} in {ctx.guild.name}")
+        gLog.debug("%s in %s", query_msg, ctx.guild.name)
         await response.edit_original_message(content=query_msg)
 
 
     @commands.slash_command(name="pause", description="Pause/Unpause the current song")
     async def pause(self, ctx: ApplicationContext):
         """Pause the currently playing song."""
-        gLog.debug(f"Got `/pause`: {ctx.guild.name} >> {ctx.author}")
+        gLog.debug("Got `/pause`: %s >> %s", ctx.guild.name, ctx.author)
 
         # Get the queue
-        (queue, response) = await self.get_server_queue(ctx)
-        if not isinstance(queue, SongQueue):
+        queue = await self.get_server_queue(ctx)
+        if type(queue) is not SongQueue:
             return
 
         # Pause the song
         msg= "Unpaused!"
         if queue.pause():
             msg = "Paused!"
-        await response.edit_original_message(content=msg)
+        await ctx.respond(content=msg)
 
 
     @commands.slash_command(name="clear", description="Clear the queue")
     async def clear_queue(self, ctx: ApplicationContext):
-        gLog.debug(f"Got `/clear`: {ctx.guild.name} >> {ctx.author}")
+        gLog.debug("Got `/clear`: %s >> %s", ctx.guild.name, ctx.author)
 
         # Get the queue
-        (queue, response) = await self.get_server_queue(ctx)
-        if not isinstance(queue, SongQueue):
+        queue = await self.get_server_queue(ctx)
+        if type(queue) is not SongQueue:
             return
 
         # Clear the queue and stop the currently playing song
         queue.clear()
         queue.skip()
-        await response.edit_original_message(content="Queue cleared!")
+        await ctx.respond(content="Queue cleared!")
 
 
     @commands.slash_command(name="skip", description="Skip the current song")
     async def skip_current_song(self, ctx: ApplicationContext):
-        gLog.debug(f"Got `/skip`: {ctx.guild.name} >> {ctx.author}")
+        gLog.debug("Got `/skip`: %s >> %s", ctx.guild.name, ctx.author)
 
         """Skip the currently playing song."""
         # Get the queue
-        (queue, response) = await self.get_server_queue(ctx)
-        if not isinstance(queue, SongQueue):
+        queue = await self.get_server_queue(ctx)
+        if type(queue) is not SongQueue:
             return
 
         # Skip the song
         queue.skip()
-        await response.edit_original_message(content="Skipped!")
+        await ctx.respond(content="Skipped!")
 
 
     @commands.slash_command(name="current", description="Shows the currently playing song")
     async def show_current(self, ctx: ApplicationContext):
         """Create and send an embed for the currently playing song."""
-        gLog.debug(f"Got `/current`: {ctx.guild.name} >> {ctx.author}")
+        gLog.debug("Got `/current`: %s >> %s", ctx.guild.name, ctx.author)
 
         # Get the queue
-        (queue, response) = await self.get_server_queue(ctx)
-        if not isinstance(queue, SongQueue):
+        queue = await self.get_server_queue(ctx)
+        if type(queue) is not SongQueue:
             return
 
         # Get the currently playing song
         current_song = queue.current_song
         if current_song is None:
             gLog.debug("No song currently playing.")
-            await response.edit_original_message(content="No song is currently playing")
+            await ctx.respond(content="No song is currently playing")
             return
 
         # Create the embed and send it
         embed = create_song_embed(current_song)
-        await response.edit_original_message(embed=embed)
+        await ctx.respond(embed=embed)
 
 
     @commands.slash_command(name="shuffle", description="Turn on/off shuffling")
     async def toggle_shuffle_mode(self, ctx: ApplicationContext):
         """Toggle the shuffle mode of a guild's queue"""
-        gLog.debug(f"Got `/shuffle`: {ctx.guild.name} >> {ctx.author}")
+        gLog.debug("Got `/shuffle`: %s >> %s", ctx.guild.name, ctx.author)
 
         # Get the queue
-        (queue, response) = await self.get_server_queue(ctx)
-        if not isinstance(queue, SongQueue):
+        queue = await self.get_server_queue(ctx)
+        if type(queue) is not SongQueue:
             return
 
         # Toggle the shuffle mode
         queue.toggle_shuffle()
 
-        gLog.debug(f"Shuffle in: {ctx.guild.name} >> {queue.shuffle}")
+        gLog.debug("Shuffle in: %s >> %s", ctx.guild.name, queue.shuffle)
 
         # Send a notification about the shuffle status
         msg = "Shuffle disabled."
         if queue.shuffle:
             msg = "Shuffle enabled"
-        await response.edit_original_message(content=msg);
+        await ctx.respond(content=msg);
 
 
     @commands.slash_command(name="loop", description="Turn on/off song looping")
     async def toggle_song_loop_mode(self, ctx: ApplicationContext):
         """Toggle the song loop mode of a guild's queue"""
-        gLog.debug(f"Got `/loop`: {ctx.guild.name} >> {ctx.author}")
+        gLog.debug("Got `/loop`: %s >> %s", ctx.guild.name, ctx.author)
 
         # Get the queue
-        (queue, response) = await self.get_server_queue(ctx)
-        if not isinstance(queue, SongQueue):
+        queue = await self.get_server_queue(ctx)
+        if type(queue) is not SongQueue:
             return
 
         # Toggle the loop mode
         queue.toggle_song_loop()
 
-        gLog.debug(f"Loop in: {ctx.guild.name} >> {queue.loop_song}")
+        gLog.debug("Loop in: %s >> %s", ctx.guild.name, queue.loop_song)
 
         # Send a notification about the shuffle status
         msg = "Looping disabled."
         if queue.loop_song:
             msg = "Looping enabled"
-        await response.edit_original_message(content=msg);
+        await ctx.respond(content=msg);
 
 
-    async def get_server_queue(self, ctx: ApplicationContext) -> (SongQueue, WebhookMessage):
+    async def get_server_queue(self, ctx: ApplicationContext) -> SongQueue:
         """
-        Returns the queue for a given server and the response that was sent
-        to the command. This function ALWAYS responds and returns a reponse
-        webhook.
+        Returns the queue for a given server.
         Also checks if the author is connected to the same channel.
 
-        If the author is not in a VC, queue is `False`.
-        Else if the bot is not connected to a VC, queue is `None`.
-        Else if the author is not in the same VC as the bot, queue is `False`.
+        If the author is not in a VC, queue is `_NO_AUTHOR_VC`.
+        Else if the bot is not connected to a VC, queue is `_BOT_NOT_IN_VC`.
+        Else if the author is not in the same VC as the bot, queue is
+        `_MISMATCH_VC`.
+
+        This function only responds to the command if it can't return a queue,
+        in which case the response explains why. If a queue is returned, the
+        caller responds with its final message itself, so that each command
+        costs a single response.
         """
-        # Get the author's voice state
-        voice = ctx.author.voice
+        # Get the author's voice state and everything else we need from the
+        # context only once
+        voice    = ctx.author.voice
+        guild_id = ctx.guild_id
+        respond  = ctx.respond
 
         # Check if the author is connected to a VC
         if voice is None:
-            resp = await ctx.respond(content="You are not connected to a VC.")
-            return (False, resp)
+            await respond(
+                content="You are not connected to a VC.", ephemeral=True)
+            return _NO_AUTHOR_VC
 
         # Get the voice channel this bot is connected to
-        queue = self.queues.get(ctx.guild_id)
-
-        # If we aren't connected to a voice channel but we do track a queue,
-        # we have been kicked from it. Destroy the queue.
+        queue = self.queues.get(guild_id)
         if queue is not None:
-            if queue.voice is None or not queue.voice.is_connected():
+            self.queues.move_to_end(guild_id)
+            queue_voice = queue.voice
+
+            # If we aren't connected to a voice channel but we do track a
+            # queue, we have been kicked from it. Destroy the queue.
+            if not voice_alive(queue_voice):
                 await queue.destroy()
-                del self.queues[ctx.guild_id]
+                self.queues.pop(guild_id, None)
                 queue = None
 
-        # Check if we are connected to a voice channel
+        # Check if we are connected to a voice channel.
+        # This one isn't ephemeral because `/join` edits it.
         if queue is None:
-            resp = await ctx.respond(content="I'm not connected to a VC!")
-            return (None, resp)
+            await respond(content="I'm not connected to a VC!")
+            return _BOT_NOT_IN_VC
 
         # Check if we are connected to the same voice channel as the author
-        if voice.channel.id != queue.voice.channel.id:
-            resp = await ctx.respond(content="You are not present in my VC.")
-            return (False, resp)
+        if voice.channel.id != queue_voice.channel.id:
+            await respond(
+                content="You are not present in my VC.", ephemeral=True)
+            return _MISMATCH_VC
 
         # Return the queue
-        resp = await ctx.respond(content="I'm connected to a VC!")
-        return (queue, resp)
+        return queue
+
+
+def voice_alive(voice) -> bool:
+    """Returns whether `voice` is a voice client that is still connected."""
+    return voice is not None and voice.is_connected()
 
 
 def create_song_embed(song: Song) -> Embed:
@@ -308,28 +356,30 @@ def create_song_embed(song: Song) -> Embed:
     if song.stream is None:
         return
 
-    # Extract the data
-    query_url = song.url
-    channel   = song.uploader
-    duration  = song.duration_formatted
-    thumbnail = song.thumbnail
-    title     = f"{song.title}"
-
     # If we have a query url, make the title clickable
-    if song.url is not None and title != "":
+    title = song.title or ""
+    query_url = song.url
+    if query_url and title:
         title = f"[{title}]({query_url})"
 
-    # If we have an uploader url, make the channel clickable
-    if song.uploader_url is not None and channel != "":
-        channel = f"[{channel}]({song.uploader_url})"
+    # If we have an uploader url, make the channel clickable.
+    # Discord rejects empty field values, so fall back to a placeholder.
+    channel = song.uploader or "Unknown"
+    uploader_url = song.uploader_url
+    if uploader_url and song.uploader:
+        channel = f"[{channel}]({uploader_url})"
 
     # Create the embed
     embed = Embed(title="Enqueued", description=title)
 
     # Add the various information fields
-    embed.add_field(name="Duration", value=duration, inline=True)
-    embed.add_field(name="Uploader", value=channel, inline=True)
-    if thumbnail is not None or thumbnail != "":
+    add_field = embed.add_field
+    add_field(name="Duration", value=song.duration_formatted, inline=True)
+    add_field(name="Uploader", value=channel, inline=True)
+
+    # Only set the thumbnail if we actually have one
+    thumbnail = song.thumbnail
+    if thumbnail:
         embed.set_thumbnail(url=thumbnail)
 
     return embed
@@ -1,4 +1,8 @@
+import atexit
 import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
 from multiprocessing import current_process
 from os import getenv
 
@@ -7,21 +11,24 @@ USE_LOG_COLORS  = True   # Whether to use colored output in the terminal
 LOG_TO_FILE     = True   # Whether to log into a file
 LOG_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 LOG_FILE        = r"siren_cog.log"
+LOG_FILE_BUFFER = 64 * 1024  # Size of the log file write buffer in bytes
 LOG_FORMAT      = "{asctime} | {levelname:^8} | {processName} | \
 ({filename}:{lineno}) >> {message}"
 
+# The logging levels that can be set through the environment
+LOG_LEVELS = {
+    "debug":    logging.DEBUG,
+    "info":     logging.INFO,
+    "warning":  logging.WARNING,
+    "error":    logging.ERROR,
+    "critical": logging.CRITICAL,
+}
+
 # Set the logging level based on environment. INFO by default
-match getenv("SIREN_LOG_LEVEL", "info").lower():
-    case "debug":
-        LOG_LEVEL = logging.DEBUG
-    case "warning":
-        LOG_LEVEL = logging.WARNING
-    case "error":
-        LOG_LEVEL = logging.ERROR
-    case "critical":
-        LOG_LEVEL = logging.CRITICAL
-    case other:
-        LOG_LEVEL = logging.INFO
+LOG_LEVEL = LOG_LEVELS.get(
+    (getenv("SIREN_LOG_LEVEL") or "info").lower(),
+    logging.INFO
+)
 
 # A log formatter capable of outputting colors
 class ColoredFormatter(logging.Formatter):
@@ -40,23 +47,76 @@ class ColoredFormatter(logging.Formatter):
         logging.CRITICAL: bold_red + LOG_FORMAT + reset
     }
 
+    def __init__(self):
+        super().__init__(LOG_FORMAT, style="{", datefmt=LOG_TIME_FORMAT)
+
+        # Build the formatters once instead of on every record
+        self._formatters = {
+            level: logging.Formatter(fmt, style="{", datefmt=LOG_TIME_FORMAT)
+            for level, fmt in self.FORMATS.items()
+        }
+
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(
-            log_fmt,
-            style="{",
-            datefmt=LOG_TIME_FORMAT
-        )
+        formatter = self._formatters.get(record.levelno)
+        if formatter is None:
+            return super().format(record)
         return formatter.format(record)
 
 
+# A file handler that doesn't flush after every record
+class BufferedFileHandler(logging.FileHandler):
+    """
+    A `FileHandler` whose stream is opened with a `LOG_FILE_BUFFER` sized
+    buffer. Records are written out in large blocks when the buffer fills up
+    or when `flush_buffer()` is called, instead of one `write()` per record.
+    """
+    def __init__(self, filename):
+        super().__init__(filename, delay=True)
+
+    def _open(self):
+        return open(
+            self.baseFilename,
+            self.mode,
+            buffering=LOG_FILE_BUFFER,
+            encoding=self.encoding,
+            errors=self.errors
+        )
+
+    def flush(self):
+        # `StreamHandler.emit()` flushes after every single record.
+        # Leave the flushing to `flush_buffer()`.
+        pass
+
+    def flush_buffer(self):
+        super().flush()
+
+
+# A queue listener that flushes buffered handlers whenever it goes idle
+class FlushingQueueListener(QueueListener):
+    def dequeue(self, block):
+        # Nothing else to write for now. Get the buffered records to the file.
+        if self.queue.empty():
+            for handler in self.handlers:
+                if isinstance(handler, BufferedFileHandler):
+                    handler.flush_buffer()
+        return super().dequeue(block)
+
+
 # Create the logger
 globalLog = logging.getLogger(__name__)
 globalLog.setLevel(LOG_LEVEL)
 
-# Create a console handler and add it to the logger
+# When running optimized (`python -O`), drop the debug messages entirely.
+# The calls then return right away, without even checking the level.
+if not __debug__:
+    def _ignore_debug(*args, **kwargs):
+        pass
+    globalLog.debug = _ignore_debug
+
+# Create a console handler and add it to the logger.
+# The handlers are left at `NOTSET`; the level of `globalLog` is the only
+# level check a record goes through.
 consoleHandler = logging.StreamHandler()
-consoleHandler.setLevel(LOG_LEVEL)
 if USE_LOG_COLORS:
     consoleHandler.setFormatter(ColoredFormatter())
 else:
@@ -65,10 +125,56 @@ else:
     )
 globalLog.addHandler(consoleHandler)
 
-# Create a file handler and add it to the logger
+# Create a file handler and add it to the logger.
+# The file is written to by a background listener thread, so logging from
+# the event loop or the player threads only appends the record to a queue.
 if LOG_TO_FILE:
-    fileHandler = logging.FileHandler(LOG_FILE)
+    fileHandler = BufferedFileHandler(LOG_FILE)
     fileHandler.setFormatter(
         logging.Formatter(LOG_FORMAT, datefmt=LOG_TIME_FORMAT, style='{')
     )
-    globalLog.addHandler(fileHandler)
+
+    queueHandler = QueueHandler(queue.Queue(-1))
+    globalLog.addHandler(queueHandler)
+
+    logListener = FlushingQueueListener(
+        queueHandler.queue,
+        fileHandler,
+        respect_handler_level=True
+    )
+    logListener.start()
+
+    # Write out the pending records on shutdown
+    atexit.register(logListener.stop)
+
+    def _flush_log_before_fork():
+        """
+        Write out the file buffer so that the child process doesn't inherit
+        (and later write out a second time) the records buffered so far.
+        The handler stays locked until the fork is done.
+        """
+        fileHandler.acquire()
+        fileHandler.flush_buffer()
+
+    def _restart_log_listener():
+        """
+        The listener thread doesn't survive a fork. Give the child process
+        its own queue and listener so that its records still get written.
+        """
+        global logListener
+        queueHandler.queue = queue.Queue(-1)
+        logListener = FlushingQueueListener(
+            queueHandler.queue,
+            fileHandler,
+            respect_handler_level=True
+        )
+        logListener.start()
+
+    # Fork hooks only exist on POSIX. Elsewhere the children are spawned,
+    # import this module anew and start their own listener anyway.
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(
+            before=_flush_log_before_fork,
+            after_in_parent=fileHandler.release,
+            after_in_child=_restart_log_listener
+        )
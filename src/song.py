@@ -1,8 +1,35 @@
 from math import ceil
+from functools import lru_cache
+import threading
 import yt_dlp
 from yt_dlp import YoutubeDL
 from log import globalLog as gLog
 
+# Options for extracting the metadata of a single song.
+# Don't parse DASH manifests and don't download whole playlists if
+# a playlist index was given.
+METADATA_YDL_OPTS = {
+    'youtube_include_dash_manifest': False,
+    'noplaylist': True,
+    'quiet': True,
+}
+
+# Options for listing the songs of a query without extracting their metadata.
+# Quietly.
+FLAT_YDL_OPTS = {
+    'extract_flat': True,
+    'quiet': True,
+}
+
+# The `YoutubeDL` instances reused by the current thread. `YoutubeDL` isn't
+# thread-safe, so every thread builds its own.
+# Every instance keeps its own HTTP handlers for its whole life, so reusing it
+# also reuses the kept-alive connections (with the `requests` backend), and
+# consecutive extractions skip the TCP and TLS handshakes.
+#     .metadata -- used by `get_metadata_from_url()`
+#     .flat     -- used by `get_urls_from_query()`
+_ytdl = threading.local()
+
 class Song:
     """Representation of a single song"""
     def __init__(self, url: str):
@@ -20,25 +47,25 @@ class Song:
         ytdl_result = get_metadata_from_url(url)
 
         self.title = ytdl_result.get("title")
-        gLog.debug(f"Title: {self.title}")
+        gLog.debug("Title: %s", self.title)
 
         self.uploader = ytdl_result.get("uploader")
-        gLog.debug(f"Uploader: {self.uploader}")
+        gLog.debug("Uploader: %s", self.uploader)
 
         self.uploader_url = ytdl_result.get("uploader_url")
-        gLog.debug(f"Uploader URL: {self.uploader_url}")
+        gLog.debug("Uploader URL: %s", self.uploader_url)
 
         self.url = ytdl_result.get("webpage_url")
-        gLog.debug(f"URL: {self.url}")
+        gLog.debug("URL: %s", self.url)
 
         self.duration = ytdl_result.get("duration")
-        gLog.debug(f"Duration: {self.duration}")
+        gLog.debug("Duration: %s", self.duration)
 
         self.thumbnail = ytdl_result.get("thumbnail")
-        gLog.debug(f"Thumbnail URL: {self.thumbnail}")
+        gLog.debug("Thumbnail URL: %s", self.thumbnail)
 
         self.duration_formatted = parse_duration(self.duration)
-        gLog.debug(f"Formatted duration: {self.duration_formatted}")
+        gLog.debug("Formatted duration: %s", self.duration_formatted)
 
         # Get the first stream url that we find
         formats = ytdl_result.get('formats')
@@ -46,12 +73,13 @@ class Song:
         if formats is None:
             return
 
-        for f in formats:
-            if f.get('acodec') is None or f['acodec'].lower() == "none":
-                continue
-            self.stream = f.get("url")
-            gLog.debug(f"Stream URL: {self.stream}")
-            return
+        # yt-dlp reports formats without audio with an `acodec` of 'none'
+        self.stream = next(
+            (f.get('url') for f in formats
+             if f.get('acodec') not in (None, 'none')),
+            None
+        )
+        gLog.debug("Stream URL: %s", self.stream)
 
 
     def __str__(self) -> str:
@@ -76,26 +104,44 @@ class Song:
         return string
 
 
+def init_metadata_extractor() -> YoutubeDL:
+    """
+    Builds the `YoutubeDL` instance that `get_metadata_from_url()` reuses in
+    this thread and returns it. If it has already been built, just returns it.
+
+    Processes that extract a lot of songs (e.g. the `SongCache` workers) should
+    call this when they start, so that the extractor setup is done once and not
+    during the first request.
+    """
+    ytdl = getattr(_ytdl, "metadata", None)
+    if ytdl is None:
+        ytdl = _ytdl.metadata = YoutubeDL(METADATA_YDL_OPTS)
+    return ytdl
+
+
+def init_flat_extractor() -> YoutubeDL:
+    """
+    Builds the `YoutubeDL` instance that `get_urls_from_query()` reuses in
+    this thread and returns it. If it has already been built, just returns it.
+    """
+    ytdl = getattr(_ytdl, "flat", None)
+    if ytdl is None:
+        ytdl = _ytdl.flat = YoutubeDL(FLAT_YDL_OPTS)
+    return ytdl
+
+
 def get_metadata_from_url(url) -> dict:
     """Get the youtube-dl metadata from a given url."""
     # Strip the url
     url = url.strip()
 
-    # Don't parse DASH manifests and don't download whole playlists if
-    # a playlist index was given.
-    ydl_opts = {
-        'youtube_include_dash_manifest': False,
-        'noplaylist': True,
-        'quiet': True,
-    }
-
     # Try and get the metadata
-    with YoutubeDL(ydl_opts) as ytdl:
-        try:
-            result = ytdl.extract_info(url, download=False)
-        except yt_dlp.DownloadError as e:
-            gLog.error(f"While downloading song info: {e}...")
-            return dict()
+    ytdl = init_metadata_extractor()
+    try:
+        result = ytdl.extract_info(url, download=False)
+    except yt_dlp.DownloadError as e:
+        gLog.error(f"While downloading song info: {e}...")
+        return dict()
 
     # If we got a list, convert it to a dictionary
     if isinstance(result, list):
@@ -108,8 +154,10 @@ def get_metadata_from_url(url) -> dict:
     return result
 
 
+@lru_cache(maxsize=1024)
 def parse_duration(duration: int) -> str:
-    """Parses the duration in seconds into a readable string"""
+    """Parses the duration in seconds into a readable string.
+    The results are cached; a lot of songs share the same duration."""
     if duration is None:
         return
 
@@ -142,17 +190,13 @@ def get_urls_from_query(query: str) -> [str]:
     if not query.startswith("http"):
         query = "ytsearch:" + query
 
-    # Do not extract metadata, only list songs. Quietly.
-    ydl_opts = {
-        "extract_flat": True,
-        "quiet": True,
-    }
-    with YoutubeDL(ydl_opts) as ytdl:
-        result = ytdl.extract_info(query, download=False)
+    # Do not extract metadata, only list songs
+    ytdl = init_flat_extractor()
+    result = ytdl.extract_info(query, download=False)
 
     # # The following debug message is extremely verbose. And is most likely
     # # not needed.
-    # gLog.debug(f"Extraction result: {result}")
+    # gLog.debug("Extraction result: %s", result)
 
     # We got a direct url to a single song
     if 'entries' not in result:
@@ -166,5 +210,5 @@ def get_urls_from_query(query: str) -> [str]:
             continue
         urls.append(url)
 
-    gLog.debug(f"Parsed urls: {urls}")
+    gLog.debug("Parsed urls: %s", urls)
     return urls
@@ -1,10 +1,28 @@
-from multiprocessing.connection import Connection
-from multiprocessing import Manager
-from queue import Empty as QueueEmpty
+import atexit
+import queue
+import sys
+import threading
+from collections import deque
+from collections import OrderedDict
 import multiprocessing as mp
 from song import Song
+from song import init_metadata_extractor
 from log import globalLog as gLog
 
+# The multiprocessing context of the background processes. On Linux they are
+# forked, so they start in about a millisecond and simply inherit everything
+# they need. Elsewhere `fork` is either unavailable or unsafe, so stick with
+# the platform default.
+if sys.platform == "linux":
+    mp_context = mp.get_context("fork")
+else:
+    mp_context = mp.get_context()
+
+# The maximum amount of songs kept in a cache. When caching another song would
+# exceed this, the least recently played song is dropped. If none of the cached
+# songs have been played, the one cached the longest ago is dropped instead.
+MAX_CACHED_SONGS = 512
+
 class SongCache:
     """
     A cache of { url: Song } pairs that extracts song metadata in background
@@ -20,42 +38,110 @@ class SongCache:
     One process per server should be enough to extract high-priority songs
     (songs that are queued up to be played next) in a timely manner but may not
     be enough to extract and cache other queued up songs.
+
+    The songs are extracted in processes rather than threads on purpose. Apart
+    from the network requests, yt-dlp does a lot of pure python work for every
+    song (parsing the pages, interpreting the player javascript). In a thread,
+    that work would hold the GIL and starve the event loop and discord's audio
+    player thread, which has to send a packet every 20ms.
+
+    Use `SongCache.get()` to get a cache. It is shared by everything in this
+    process that asks for the same `pool_size`.
     """
+    # Caches created through `SongCache.get()`
+    # { pool_size: SongCache }
+    _instances = {}
+
+    @classmethod
+    def get(cls, pool_size: int):
+        """
+        Returns the cache with `pool_size` background processes, creating it if
+        it doesn't exist yet. Reloading the cog reuses the running processes
+        instead of starting another pool next to them.
+        """
+        cache = cls._instances.get(pool_size)
+        if cache is None:
+            cache = cls(pool_size)
+            cls._instances[pool_size] = cache
+        return cache
+
+
+    @classmethod
+    def shutdown_all(cls):
+        """Shuts down every cache created through `SongCache.get()`."""
+        for cache in cls._instances.values():
+            cache.shutdown()
+        cls._instances.clear()
+
+
     def __init__(self, pool_size: int):
         # Check that we have been given a valid pool_size
         if pool_size < 1:
             raise ValueError("pool_size is too low.")
 
-        # The manager for the shared internal `self.cache`
-        self.shared_manager = Manager()
-
-        # The internal cache for song metadata
+        # The internal cache for song metadata. It lives in this (the parent)
+        # process only; the background processes never read it and send the
+        # songs they extract through `_results` instead.
+        # Bounded by `MAX_CACHED_SONGS`, least recently cached (or queued up)
+        # first.
         # { url: Song }
-        self.cache = self.shared_manager.dict()
+        self.cache = OrderedDict()
+
+        # The cached urls that have been handed out by
+        # `prioritized_extract_cache()` (that is, played) and haven't been
+        # queued up again since, least recently played first.
+        # These are dropped from the cache first, so that the songs extracted
+        # ahead of time are still there when they play.
+        # { url: None }
+        self._played = OrderedDict()
+
+        # A queue of (url, Song) pairs extracted by the background processes.
+        # Invalid songs are sent as (url, None).
+        # Moved into `self.cache` by the `_collector_thread`, which is the only
+        # thing that ever writes into the cache. Because that thread is always
+        # waiting on this queue, the puts don't need `mp.Queue`'s feeder thread
+        # to avoid blocking the background processes.
+        self._results = mp_context.SimpleQueue()
+
+        # The urls that have been requested but aren't cached yet, along with
+        # the queues of the callers waiting for them. Every url is extracted
+        # only once, no matter how many times it is requested in the meantime.
+        # { url: [ song_queue ] }
+        self._pending = dict()
+
+        # The urls of `_pending` that a background process is extracting
+        self._in_flight = set()
 
         # A queue of urls. Urls in this queue get cached as soon as possible.
         # This is usually a queue of all the `SongQueue.next_song`s.
-        #
-        # The elements of the queue are (url, flag). Url is the url string that
-        # is to be extracted. The `flag` is a flag (`multiprocessing.Event`)
-        # that is to be set when the metadata is extracted.
-        self.priority_url_queue = mp.Queue()
+        self._priority_urls = deque()
 
-        # A queue of urls. If `priority_url_queue` is empty, songs in this queue
+        # A queue of urls. If `_priority_urls` is empty, songs in this queue
         # get cached instead. This is usually a queue of all songs queued up
         # in `SongQueue.songs` that AREN'T `SongQueue.next_song`.
         # That is, songs which have to wait for _at least_ the `current_song`
         # and `next_song` to finish playing.
-        self.url_queue = mp.Queue()
+        self._urls = deque()
+
+        # The queue the background processes take urls from.
+        #
+        # Urls are only put into it when there's an idle process to take them,
+        # so it never builds up and the order in which songs get extracted is
+        # decided by the two queues above. That also means it doesn't need
+        # the feeder thread and buffering of `mp.Queue`.
+        self._work_queue = mp_context.SimpleQueue()
+
+        # The amount of background processes that aren't extracting a song
+        self._idle_processes = pool_size
 
-        # Whether a song has been put into one of the inner song queues
-        self._song_available = mp.Event()
-        self._song_available.clear()
+        # Guards the cache, the pending urls, the two url queues and
+        # `_idle_processes`
+        self._lock = threading.Lock()
 
         # The pool of background running processes
         self.pool = []
         for i in range(pool_size):
-            self.pool.append(mp.Process(
+            self.pool.append(mp_context.Process(
                 target=self._wait_for_songs,
                 daemon=True,
                 name=f"Cache-{i}",
@@ -65,64 +151,140 @@ class SongCache:
         for process in self.pool:
             process.start()
 
+        # The thread that caches the extracted songs and hands the processes
+        # new urls. Started after the processes so they aren't forked with it.
+        self._collector_thread = threading.Thread(
+            target=self._collect_results,
+            daemon=True,
+            name="Cache-collector",
+        )
+        self._collector_thread.start()
 
-    def _wait_for_songs(self):
+
+    def __getstate__(self):
         """
-        The target function of every background running caching process.
+        When the background processes aren't forked, they get a pickled copy
+        of the cache. They only need the two queues they talk to the parent
+        through; everything else is used by the parent only (and the lock
+        and the processes can't be pickled anyway).
+        """
+        return {
+            "_work_queue": self._work_queue,
+            "_results":    self._results,
+        }
+
+
+    def shutdown(self):
+        """Stops the background processes."""
+        for process in self.pool:
+            process.terminate()
+        for process in self.pool:
+            process.join()
 
-        In an infinite loop, it waits for a song to appear in a queue to
-        extract its metadata and cache it.
+
+    def _collect_results(self):
+        """
+        The target function of the collector thread in the parent process.
+
+        In an infinite loop, it waits for a background process to extract a
+        song, caches it, sends it to everyone waiting for it and hands the now
+        idle process another url.
         """
         while True:
-            # Try and get a song from the priority queue
-            try:
-                (url, song_pipe) = self.priority_url_queue.get(block=False)
-            except QueueEmpty as e:
-                song_pipe = None
-                url       = None
-
-            # If we fail, get one from the normal queue
-            if url is None:
-                try:
-                    url = self.url_queue.get(block=False)
-                except QueueEmpty as e:
-                    pass
-
-            # If we still got nothing, some other process got the url and there
-            # are no other urls available. Unset the song available flag and
-            # wait for a new one to appear
-            if url is None:
-                self._song_available.clear()
-                self._song_available.wait()
-                continue
+            (url, song) = self._results.get()
+            with self._lock:
+                self.cache[url] = song
+                self._in_flight.discard(url)
+                song_queues = self._pending.pop(url, [])
+                if song_queues:
+                    self._mark_played(url)
+                self._evict()
+                self._idle_processes += 1
+                self._schedule()
 
-            gLog.debug(f"Got a url request: {url}")
-            gLog.debug(f"Pipe: {song_pipe}")
+            for song_queue in song_queues:
+                song_queue.put(song)
 
-            # At this point we have the url
 
-            # Check if it isn't cached already
-            if url in self.cache:
-                gLog.debug(f"Song present in cache")
-                if song_pipe is not None:
-                    safe_pipe_send(song_pipe, self.cache[url])
+    def _schedule(self):
+        """
+        Hands the queued up urls to the idle background processes, prioritized
+        urls first. Has to be called with `self._lock` held.
+        """
+        while self._idle_processes > 0:
+            if self._priority_urls:
+                url = self._priority_urls.popleft()
+            elif self._urls:
+                url = self._urls.popleft()
+            else:
+                return
+
+            # A url can be queued up in both queues. Skip it if it has been
+            # extracted or is being extracted already.
+            if url not in self._pending or url in self._in_flight:
                 continue
 
-            # Extract the song
-            song = Song(url)
+            self._in_flight.add(url)
+            self._idle_processes -= 1
+            self._work_queue.put(url)
+
+
+    def _mark_played(self, url: str):
+        """
+        Marks a cached url as the most recently played one.
+        Has to be called with `self._lock` held.
+        """
+        self._played[url] = None
+        self._played.move_to_end(url)
 
-            gLog.debug(f"Extracted song: {song}")
 
-            # Cache the song. If it is invalid, cache it as `None`
-            if song.stream is None:
-                self.cache[url] = None
+    def _evict(self):
+        """
+        Drops songs from the cache until it holds at most `MAX_CACHED_SONGS`.
+        The least recently played songs go first, then the songs cached the
+        longest ago. A song dropped before it plays is simply extracted again
+        when it is requested. Has to be called with `self._lock` held.
+        """
+        while len(self.cache) > MAX_CACHED_SONGS:
+            if self._played:
+                (url, _) = self._played.popitem(last=False)
+                self.cache.pop(url, None)
             else:
-                self.cache[url] = song
+                self.cache.popitem(last=False)
+
 
-            # If we're extracting from the priority queue, send the song through
-            # the pipe we were given
-            if song_pipe is not None:
-                safe_pipe_send(song_pipe, song)
+    def _wait_for_songs(self):
+        """
+        The target function of every background running caching process.
+
+        In an infinite loop, it waits for the parent to hand it a url to
+        extract its metadata and send it back to be cached.
+        """
+        # Set up the extractor once, before the first request comes in
+        init_metadata_extractor()
+
+        while True:
+            # Wait for a url. The parent has already checked that it isn't
+            # cached.
+            url = self._work_queue.get()
+
+            gLog.debug("Got a url request: %s", url)
+
+            # Extract the song. The parent counts on getting a result for
+            # every url, so don't let an unexpected error kill the process.
+            # An invalid song is cached as `None`.
+            try:
+                song = Song(url)
+                gLog.debug("Extracted song: %s", song)
+                if song.stream is None:
+                    song = None
+            except Exception as e:
+                gLog.error(f"While extracting {url}: {e}")
+                song = None
+
+            # Send the song to the parent to cache and pass on to the callers
+            # waiting for it
+            self._results.put((url, song))
 
 
     def extract_cache(self, urls: [str]):
@@ -134,49 +296,65 @@ class SongCache:
         If you need a single song to be extracted as soon as possible, use
         `prioritized_extract_cache()`.
         """
-        gLog.debug(f"Received urls to cache: {urls}")
+        gLog.debug("Received urls to cache: %s", urls)
 
         # Make sure we get at least one song in a list
         if not isinstance(urls, list) or len(urls) == 0:
             return
 
-        # Put the songs into the queue
-        for url in urls:
-            self.url_queue.put(url)
-
-        # Set the song availability flag
-        self._song_available.set()
-
-
-    def prioritized_extract_cache(self, url: str, song_pipe: Connection):
+        # Queue up the songs that aren't cached or requested already
+        with self._lock:
+            for url in urls:
+                # A cached song that is queued up again isn't the first to be
+                # dropped anymore
+                if url in self.cache:
+                    self._played.pop(url, None)
+                    self.cache.move_to_end(url)
+                    continue
+                if url in self._pending:
+                    continue
+                self._pending[url] = []
+                self._urls.append(url)
+            self._schedule()
+
+
+    def prioritized_extract_cache(self, url: str, song_queue: queue.SimpleQueue):
         """
         Extracts and caches a single song in the background as soon as possible.
-        When the extraction finishes and the song gets cached, it is transmitted
-        through the `song_pipe` back to the caller.
+        When the extraction finishes and the song gets cached, it is put into
+        the `song_queue` of the caller.
         """
-        gLog.debug(f"Received url to cache with priority: {url}")
+        gLog.debug("Received url to cache with priority: %s", url)
 
         # Make sure we were given a valid string
         if not isinstance(url, str):
-            safe_pipe_send(song_pipe, None)
+            song_queue.put(None)
             return None
 
-        # Pass the pipe and the song to the priority queue
-        self.priority_url_queue.put((url, song_pipe))
-
-        # Set the song availability flag
-        self._song_available.set()
+        with self._lock:
+            # If the song is already cached, send it right away
+            if url in self.cache:
+                gLog.debug("Song present in cache")
+                self._mark_played(url)
+                song_queue.put(self.cache[url])
+                return
+
+            # If the song has been requested already, wait for that extraction
+            # instead of starting another one
+            song_queues = self._pending.get(url)
+            if song_queues is not None:
+                gLog.debug("Song already requested")
+                song_queues.append(song_queue)
+
+                # If it's only waiting in the normal queue, move it up
+                if url not in self._in_flight:
+                    self._priority_urls.append(url)
+            else:
+                self._pending[url] = [song_queue]
+                self._priority_urls.append(url)
 
+            self._schedule()
 
-def safe_pipe_send(pipe: Connection, obj) -> bool:
-    """
-    A safe wrapper around `pipe.send` that doesn't let any exceptions through.
 
-    If the pipe we send the `obj` through is not corrupted, this function
-    returns True, otherwise False.
-    """
-    try:
-        pipe.send(obj)
-    except BrokenPipeError as e:
-        gLog.debug(f"Got pipe error: {e}")
-        return False
+# Join the background processes on exit
+atexit.register(SongCache.shutdown_all)
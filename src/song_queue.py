@@ -1,8 +1,9 @@
-import multiprocessing as mp
+import queue
 import threading
 import discord
-from random import randint
+from random import randrange
 from itertools import islice
+from collections import deque
 from song_cache import SongCache
 from song import Song
 from log import globalLog as gLog
@@ -12,13 +13,25 @@ class SongQueue:
 
     Songs are enqueued as urls and cached in the `song_cache`.
     """
+    # FFMPEG input options of every played song.
+    # Prevent the stream from closing on lost connections.
+    _BEFORE_OPTIONS = (
+        "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+    )
+
+    # FFMPEG output options of every played song.
+    # Don't flush the output pipe after every tiny packet. Let the PCM fill
+    # ffmpeg's output buffer and cross the pipe in fewer, larger writes.
+    _OPTIONS = "-flush_packets 0"
+
     def __init__(self, song_cache: SongCache):
-        # The song queue. A list of strings of urls: [ `url`: str ]
-        self.songs = list()
+        # The song queue. A deque of strings of urls: [ `url`: str ]
+        # Songs are usually taken from the front, which is O(1) for a deque.
+        self.songs = deque()
 
-        # An event that will be set if there is at least one song available
-        self._song_available = threading.Event()
-        self._song_available.clear()
+        # Guards `songs`. Waiters in `next()` are notified when urls are pushed
+        # to the queue (or when the queue is destroyed).
+        self._cv = threading.Condition()
 
         # Extracted song metadata cache
         self.cache = song_cache
@@ -33,44 +46,57 @@ class SongQueue:
         # Whether we choose the next song randomly
         self.shuffle = False
 
+        # Whether the currently playing song has been paused by `pause()`
+        self._is_paused = False
+
         # The voice channel this queue belongs to
         self.voice = None
 
         # Threads and thread stuff
 
-        # Indicates whether the next song should be played
-        self._start_next_song = threading.Event()
-        self._start_next_song.clear()
+        # Released every time the current song finishes playing, so that the
+        # player thread can start the next one
+        self._finished = threading.Semaphore(0)
+
+        # Queue the songs requested through `prioritized_extract_cache()` are
+        # put into. They are put there by the cache's collector thread, which
+        # lives in this process as well, so nothing has to be pickled.
+        # It never holds more than the one song we have requested (plus the
+        # `None` put there to wake the player thread up when stopping).
+        self._ready_songs = queue.SimpleQueue()
+        self._ready_songs.put(None)
 
         # Player background thread
         self._player_thread = threading.Thread(target=self._song_player_target)
 
-        # Whether the threads should be stopped.
-        # This variable is checked on each loop in the thread and is usually
-        # False, unless the queue is deleted or the threads are to be stopped
-        # for whatever other reason.
-        self._stop_threads = False
+        # Set when the threads should be stopped.
+        # It is checked on each loop in the thread and is usually clear,
+        # unless the queue is deleted or the threads are to be stopped for
+        # whatever other reason.
+        self._stop = threading.Event()
 
         self._player_thread.start()
 
 
     def __getitem__(self, item):
         if isinstance(item, slice):
-            return list(islice(
-                self.songs,
-                item.start,
-                item.stop,
-                item.step)
-            )
+            with self._cv:
+                # Resolve negative and missing bounds like a list would.
+                # `islice` can't take them, but it can take the results.
+                (start, stop, step) = item.indices(len(self.songs))
+
+                # Walking a deque backwards isn't possible without copying it
+                if step < 0:
+                    return list(self.songs)[item]
+
+                return list(islice(self.songs, start, stop, step))
         else:
             return self.songs[item]
 
 
     def __delitem__(self, idx):
-        # If the queue will be empty, clear the song availibility flag
-        if len(self.songs) == 1:
-            self._song_available.clear()
-        del self.songs[idx]
+        with self._cv:
+            del self.songs[idx]
 
 
     def __iter__(self):
@@ -78,11 +104,8 @@ class SongQueue:
 
 
     def __iadd__(self, value):
-        if not isinstance(value, list) and len(value) == 0:
-            return
-        self.songs += value
-        self.cache.extract_cache(value)
-        self._song_available.set()
+        self.extend(value)
+        return self
 
 
     def __len__(self):
@@ -92,38 +115,66 @@ class SongQueue:
     def __del__(self):
         """Explicit destructor"""
         gLog.debug("Destructor called.")
+        self.stop()
 
+
+    def stop(self):
+        """
+        Stops the player thread and unblocks everything waiting on this queue.
+        Doesn't touch the voice connection; use `destroy()` to disconnect too.
+        """
         # Stop all threads
-        self._stop_threads = True
+        self._stop.set()
         gLog.debug("Stopped threads.")
 
         # Unblock all blocking operations.
-        self._song_available.set()
-        self._start_next_song.set()
+        with self._cv:
+            self._cv.notify_all()
+        self._ready_songs.put(None)
+        self._finished.release()
         gLog.debug("Unblocked operations.")
 
 
     async def destroy(self):
-        self.__del__()
+        """Stops the queue and disconnects from its voice channel."""
+        self.stop()
 
         # Disconnect from the voice channel
         if self.voice is not None and self.voice.is_connected():
-            gLog.debug(f"Disconnected from voice {self.voice}.")
+            gLog.debug("Disconnected from voice %s.", self.voice)
             await self.voice.disconnect()
 
 
     def push(self, url: str, metadata: Song = None):
         """Pushes a url to the back of the queue"""
-        self.songs.append(url)
-        self.cache.extract_cache([value])
-        self._song_available.set()
+        self.extend([url])
+
+
+    def extend(self, urls: [str]):
+        """
+        Pushes urls to the back of the queue. All of them are handed to the
+        cache in a single batch, so their metadata is extracted in parallel.
+        """
+        urls = list(urls)
+        if len(urls) == 0:
+            return
+        with self._cv:
+            self.songs.extend(urls)
+            self._cv.notify()
+        self.cache.extract_cache(urls)
 
 
     def pop(self, idx: int = -1) -> str:
         """Pops and returns a url from the queue"""
-        if len(self.songs) == 1:
-            self._song_available.clear()
-        return self.songs.pop(idx)
+        with self._cv:
+            # Both ends are O(1), anything in between has to be shifted
+            if idx == 0:
+                return self.songs.popleft()
+            if idx == -1:
+                return self.songs.pop()
+            url = self.songs[idx]
+            del self.songs[idx]
+            return url
 
 
     def next(self, block: bool = False) -> str:
@@ -134,19 +185,26 @@ class SongQueue:
 
         If `block` is True, will wait for a new url to get queued up if there
         isn't one already. If False, will return None.
+        Also returns None if the queue is destroyed while waiting.
         """
-        # If there isn't a song available and we're not blocking, return.
-        # Otherwise wait for a song to appear.
-        if not self._song_available.is_set():
-            if not block:
-                return None
-            self._song_available.wait()
-
-        # Get a song
-        idx = 0
-        if self.shuffle:
-            idx = randint(0, len(self.songs) - 1)
-        url = self.pop(idx)
+        with self._cv:
+            # If there isn't a song available and we're not blocking, return.
+            # Otherwise wait until a url is pushed to the queue.
+            while not self.songs:
+                if not block or self._stop.is_set():
+                    return None
+                self._cv.wait()
+
+            # Get a song. When shuffling, take a random url out of the queue.
+            # The rest of the queue keeps its order, so turning shuffle off
+            # plays it as it was queued up.
+            songs = self.songs
+            if self.shuffle:
+                idx = randrange(len(songs))
+                url = songs[idx]
+                del songs[idx]
+            else:
+                url = songs.popleft()
 
         # Return the url
         return url
@@ -155,18 +213,20 @@ class SongQueue:
     def clear(self):
         """Clears the queue"""
         # Invalidate the song but don't push it back to the queue
-        self._song_available.clear()
-        self.songs.clear()
+        with self._cv:
+            self.songs.clear()
 
 
     def pause(self) -> bool:
         """Pause/Unpause the current song and return whether the song is paused
         or not."""
-        if self.voice.is_paused():
+        if self._is_paused:
             self.voice.resume()
+            self._is_paused = False
             return False
         elif self.voice.is_playing():
             self.voice.pause()
+            self._is_paused = True
             return True
 
 
@@ -185,63 +245,40 @@ class SongQueue:
         # Stop looping the song
         self.loop_song = False
 
-        # Simply stop playing and the background task will queue up a new song
-        if self.voice.is_playing():
+        # Simply stop playing and the background task will queue up a new song.
+        # A paused song isn't playing, but it has to be stopped all the same.
+        if self._is_paused or self.voice.is_playing():
             self.voice.stop()
+        self._is_paused = False
 
 
     def _song_player_target(self):
         """
         The target function running in the background that plays music in a VC.
         """
-        # Pipe used in `prioritized_extract_cache()`
-        (receiver, transmitter) = mp.Pipe()
-        transmitter.send(None)
-
         # Loop for as long as the queue is alive
-        while not self._stop_threads:
-            gLog.debug(f"Another cycle in player target")
+        while not self._stop.is_set():
+            gLog.debug("Another cycle in player target")
 
-            # If we're not looping the current song
+            # If we're not looping the current song, take the next one
             if not self.loop_song:
-                gLog.debug(f"Song is not looping.")
-
-                # Wait for the extraction of the next song to finish
-                self.current_song = receiver.recv()
-                gLog.debug(f"Received song: {self.current_song}. Caching next.")
-
-                # Try and cache a new song
-                next_url = self.next(block=False)
-                self.cache.prioritized_extract_cache(next_url, transmitter)
+                gLog.debug("Song is not looping.")
+                self.current_song = self._receive_song()
 
             # If we still don't have a song to play right now
             while self.current_song is None:
-                gLog.debug(f"Getting a new song in loop")
+                gLog.debug("Getting a new song in loop")
 
-                # Wait for the next song to get cached
-                self.current_song = receiver.recv()
-                gLog.debug(f"Received song: {self.current_song}. Caching next.")
-
-                # Get the next url from the queue.
-                # If the current song is still None, block until there is a url
-                # for sure.
-                if self.current_song is None:
-                    next_url = self.next(block=True)
-                else:
-                    next_url = self.next(block=False)
-                gLog.debug(f"Next url in the queue: {next_url}")
-
-                # Cache the next song before we play it
-                self.cache.prioritized_extract_cache(next_url, transmitter)
-
-            # FFMPEG options to prevent stream closing on lost connections
-            before_options  = "-reconnect 1 -reconnect_streamed 1"
-            before_options += " -reconnect_delay_max 5"
+                # The queue was destroyed while we were waiting for a url
+                if self._stop.is_set():
+                    return
+                self.current_song = self._receive_song()
 
             # Play the song and when it stops, call `_play_next_song`
             source = discord.FFmpegPCMAudio(
                 self.current_song.stream,
-                before_options=before_options
+                before_options=self._BEFORE_OPTIONS,
+                options=self._OPTIONS
             )
 
             # If the bot leaves the channel while playing a song, it throws
@@ -253,19 +290,43 @@ class SongQueue:
                 break
 
             # Wait for the current song to stop playing
-            gLog.debug(f"Waiting for the current song to finish playing.")
-            self._start_next_song.wait()
-            self._start_next_song.clear()
+            gLog.debug("Waiting for the current song to finish playing.")
+            self._finished.acquire()
+
+
+    def _receive_song(self) -> Song:
+        """
+        Waits for the song requested into `_ready_songs` to be extracted and
+        returns it. Before returning, the url after it is requested, so that it
+        is extracted while the returned song plays.
+
+        If the received song is None (invalid, or there was nothing queued up),
+        blocks until there is a url to request.
+        If the queue is stopped in the meantime, returns None.
+        """
+        song = self._ready_songs.get()
+        if self._stop.is_set():
+            return None
+        gLog.debug("Received song: %s. Caching next.", song)
+
+        next_url = self.next(block=song is None)
+        gLog.debug("Next url in the queue: %s", next_url)
+        self.cache.prioritized_extract_cache(next_url, self._ready_songs)
+
+        return song
 
 
     def _play_next_song(self, error=None):
         """
         Callback to `self.voice.play`. Is called when a song finishes playing.
-        Sets the `self._start_next_song` flag so that another song can play
+        Releases `self._finished` so that another song can play
         in `_song_player_target`.
         """
         if error:
             gLog.critical(f"While trying to play next song: {str(error)}")
 
+        # The next song starts unpaused
+        self._is_paused = False
+
         # Signal that we can start playing the next song
-        self._start_next_song.set()
+        self._finished.release()